@@ -39,6 +39,7 @@ def get_sender_receiver(device, args) -> (Sender, Receiver):
         discrete_communication=args.discrete_communication,
         gumbel_softmax=args.gumbel_softmax,
         rl=args.rl,
+        cuda_graphs=args.cuda_graphs,
     )
 
     receiver = Receiver(
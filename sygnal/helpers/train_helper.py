@@ -45,25 +45,27 @@ class TrainHelper:
         messages = []
 
         model.eval()
-        for batch in dataloader:
-            target, distractors, indices, lkey = batch
-
-            vmd = None
-
-            _, loss_item, acc, msg = model.forward(target, distractors, vmd)
-
-            if not rl:
-                loss_meter.update(loss_item)
-                acc_meter.update(acc)
-            else:
-                combined_loss, hinge_loss, rl_loss, entropy = loss_item
-                combined_loss_meter.update(combined_loss)
-                hinge_loss_meter.update(hinge_loss)
-                rl_loss_meter.update(rl_loss)
-                entropy_meter.update(entropy)
-                acc_meter.update(acc)
-
-            messages.append(msg)
+        # Sender outputs are inference tensors at eval time, keep them out of autograd
+        with torch.no_grad():
+            for batch in dataloader:
+                target, distractors, indices, lkey = batch
+
+                vmd = None
+
+                _, loss_item, acc, msg = model.forward(target, distractors, vmd)
+
+                if not rl:
+                    loss_meter.update(loss_item)
+                    acc_meter.update(acc)
+                else:
+                    combined_loss, hinge_loss, rl_loss, entropy = loss_item
+                    combined_loss_meter.update(combined_loss)
+                    hinge_loss_meter.update(hinge_loss)
+                    rl_loss_meter.update(rl_loss)
+                    entropy_meter.update(entropy)
+                    acc_meter.update(acc)
+
+                messages.append(msg)
 
         if not rl:
             return (loss_meter, acc_meter, torch.cat(messages, 0))
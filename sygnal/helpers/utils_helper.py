@@ -2,6 +2,15 @@ import torch
 from torch.distributions.relaxed_categorical import RelaxedOneHotCategorical
 
 
+@torch.jit.script
+def _gumbel_softmax_hard(
+    logits: torch.Tensor, gumbel: torch.Tensor, tau: float
+) -> torch.Tensor:
+    y = torch.softmax((logits + gumbel) / tau, dim=-1)
+    y_hard = torch.zeros_like(y).scatter_(-1, y.argmax(dim=-1, keepdim=True), 1.0)
+    return (y_hard - y).detach() + y
+
+
 class UtilsHelper:
     def calculate_gumbel_softmax(self, probs, tau, hard):
         """ Computes sampling from the Gumbel Softmax (GS) distribution
@@ -21,3 +30,40 @@ class UtilsHelper:
 
         return y
         # return torch.argmax(y, dim=-1).long()
+
+    def sample_gumbel(self, shape, device):
+        """ Draws standard Gumbel noise. Drawing the noise for several sampling steps
+        at once replaces many small random kernels by a single one.
+        Args:
+            shape (tuple): shape of the noise, e.g. [n_steps, batch_size, n_classes]
+            device (torch.device): device to draw the noise on
+        """
+
+        u = torch.rand(shape, device=device).clamp_min_(1e-20)
+        return -torch.log(-torch.log(u))
+
+    def calculate_gumbel_softmax_hard(self, logits, tau, gumbel=None):
+        """ Computes a hard sample from the Gumbel Softmax (GS) distribution with a
+        straight-through gradient. Same as calculate_gumbel_softmax with hard=True, but
+        takes unnormalized logits and runs as a single scripted function.
+        Args:
+            logits (torch.tensor): unnormalized log probabilities of shape [batch_size, n_classes]
+            tau (float): temperature parameter for the GS
+            gumbel (torch.tensor): pre-sampled Gumbel noise of the shape of logits, drawn if None
+        """
+
+        if gumbel is None:
+            gumbel = self.sample_gumbel(logits.shape, logits.device)
+        return _gumbel_softmax_hard(logits, gumbel, float(tau))
+
+    def calculate_gumbel_max(self, logits, gumbel=None):
+        """ Samples class indices with the Gumbel-max trick. Equivalent to sampling
+        from Categorical(logits=logits), without normalizing the logits.
+        Args:
+            logits (torch.tensor): unnormalized log probabilities of shape [batch_size, n_classes]
+            gumbel (torch.tensor): pre-sampled Gumbel noise of the shape of logits, drawn if None
+        """
+
+        if gumbel is None:
+            gumbel = self.sample_gumbel(logits.shape, logits.device)
+        return torch.argmax(logits + gumbel, dim=-1)
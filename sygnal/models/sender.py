@@ -1,20 +1,59 @@
+from typing import Tuple
+
 import torch
 import torch.nn as nn
-from torch.distributions.categorical import Categorical
 from torch.nn import functional as F
 
 
 from .vector_quantization import (
-    to_one_hot,
     VectorQuantization,
-    EmbeddingtableDistances,
     HardMax,
+    embeddingtable_distances,
 )
 
 from ..helpers.utils_helper import UtilsHelper
 
 
+@torch.jit.script
+def _lstm_cell(
+    input: torch.Tensor,
+    hx: torch.Tensor,
+    cx: torch.Tensor,
+    w_ih: torch.Tensor,
+    w_hh: torch.Tensor,
+    b_ih: torch.Tensor,
+    b_hh: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Same computation as nn.LSTMCell, scripted so that the pointwise gate
+    operations get fused and the unroll loop avoids the module call overhead.
+    Gate order follows nn.LSTMCell: input, forget, cell, output.
+    """
+    gates = torch.mm(input, w_ih.t()) + b_ih + torch.mm(hx, w_hh.t()) + b_hh
+    ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+
+    ingate = torch.sigmoid(ingate)
+    forgetgate = torch.sigmoid(forgetgate)
+    cellgate = torch.tanh(cellgate)
+    outgate = torch.sigmoid(outgate)
+
+    cy = (forgetgate * cx) + (ingate * cellgate)
+    hy = outgate * torch.tanh(cy)
+
+    return hy, cy
+
+
 class Sender(nn.Module):
+    # Fixed at construction. Declared final, so that TorchScript treats them as
+    # constants when the sender is compiled.
+    vocab_size: torch.jit.Final[int]
+    output_len: torch.jit.Final[int]
+    sos_id: torch.jit.Final[int]
+    eos_id: torch.jit.Final[int]
+    hidden_size: torch.jit.Final[int]
+    tau: torch.jit.Final[float]
+    cell_type: torch.jit.Final[str]
+
     def __init__(
         self,
         vocab_size,  # Specifies number of words in baseline setting. In VQ-VAE Setting:
@@ -37,6 +76,7 @@ class Sender(nn.Module):
         discrete_communication=False,
         gumbel_softmax=False,
         rl=False,
+        cuda_graphs=False,  # If True, replay the unroll from CUDA graphs at eval time
     ):
         super().__init__()
         if vqvae and not rl and not discrete_communication:
@@ -76,6 +116,10 @@ class Sender(nn.Module):
         self.embedding = nn.Parameter(
             torch.empty((vocab_size, embedding_size), dtype=torch.float32)
         )
+        # int8 copy of the embedding table for inference, see quantize_embedding_int8.
+        # Not persistent, so checkpoints only hold the fp32 table.
+        self.register_buffer("embedding_int8", None, persistent=False)
+        self.register_buffer("embedding_scales", None, persistent=False)
 
         if not vqvae:
             self.linear_out = nn.Linear(
@@ -106,9 +150,28 @@ class Sender(nn.Module):
 
         self.rl = rl
 
+        self.cuda_graphs = cuda_graphs
+        self._cuda_graphs = {}  # (batch_size, greedy) -> (graph, static input, static outputs)
+
         if reset_params:
             self.reset_parameters()
 
+    def __getstate__(self):
+        # Captured CUDA graphs are tied to this process and its memory pool, so
+        # pickled and deep-copied senders start without any.
+        state = self.__dict__.copy()
+        state["_cuda_graphs"] = {}
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        # Senders pickled as a whole (see --sender-path) before these attributes
+        # were introduced get their defaults.
+        for name in ("embedding_int8", "embedding_scales"):
+            if name not in self._buffers:
+                self.register_buffer(name, None, persistent=False)
+        self.__dict__.setdefault("cuda_graphs", False)
+        self.__dict__.setdefault("_cuda_graphs", {})
 
     def reset_parameters(self):
         nn.init.normal_(self.embedding, 0.0, 0.1)
@@ -118,7 +181,7 @@ class Sender(nn.Module):
         if self.vqvae:
             nn.init.normal_(self.e, 0.0, 0.1)
 
-        if type(self.rnn) is nn.LSTMCell:
+        if self.cell_type == "lstm":
             nn.init.xavier_uniform_(self.rnn.weight_ih)
             nn.init.orthogonal_(self.rnn.weight_hh)
             nn.init.constant_(self.rnn.bias_ih, val=0)
@@ -129,14 +192,65 @@ class Sender(nn.Module):
                 self.rnn.bias_hh[self.hidden_size : 2 * self.hidden_size], val=1
             )
 
-    def _init_state(self, hidden_state, rnn_type):
+    def quantize_embedding_int8(self):
+        """
+            Stores an int8 copy of the embedding table with one scale per row, which is
+            used instead of the fp32 table for the embedding lookups outside of training.
+            The copy is not updated by training, so call this again whenever the
+            embedding has changed.
+        """
+        with torch.no_grad():
+            scales = self.embedding.abs().amax(dim=1).clamp_min(1e-12) / 127.0
+            self.embedding_int8 = torch.round(self.embedding / scales.unsqueeze(1)).to(
+                torch.int8
+            )
+            self.embedding_scales = scales
+        self._cuda_graphs.clear()
+
+    def export_for_inference(self, hidden_state):
+        """
+            Exports the eval time sender as a frozen TorchScript module, optimized for
+            inference. The forward pass is traced rather than scripted, since it calls
+            Python helpers, so the export is specific to the current settings of the
+            sender (greedy, vqvae, ...) and to the batch size of hidden_state.
+            The exported module is run on hidden_state twice, to pay the JIT
+            optimization cost before it is used.
+            Args:
+                hidden_state (torch.tensor): Example input, of the shape used for inference.
+            Returns:
+                The frozen and optimized torch.jit.ScriptModule
+        """
+        self.eval()
+        with torch.no_grad():
+            traced = torch.jit.trace(self, hidden_state, check_trace=False)
+            exported = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+            for _ in range(2):
+                exported(hidden_state)
+
+        return exported
+
+    def _embed(self, token_index):
+        """
+            Looks up the embeddings of a batch of token indices. Uses the int8 table
+            outside of training if quantize_embedding_int8 has been called.
+            Args:
+                token_index (torch.tensor): Token indices [batch_size].
+            Returns:
+                emb: The embedded tokens [batch_size, embedding_size]
+        """
+        if not self.training and self.embedding_int8 is not None:
+            emb = self.embedding_int8.index_select(0, token_index).float()
+            return emb * self.embedding_scales.index_select(0, token_index).unsqueeze(1)
+
+        return F.embedding(token_index, self.embedding)
+
+    def _init_state(self, hidden_state):
         """
             Handles the initialization of the first hidden state of the decoder.
             Hidden state + cell state in the case of an LSTM cell or
             only hidden state in the case of a GRU cell.
             Args:
                 hidden_state (torch.tensor): The state to initialize the decoding with.
-                rnn_type (type): Type of the rnn cell.
             Returns:
                 state: (h, c) if LSTM cell, h if GRU cell
                 batch_size: Based on the given hidden_state if not None, 1 otherwise
@@ -151,7 +265,7 @@ class Sender(nn.Module):
             h = hidden_state  # batch_size, hidden_size
 
         # c0
-        if rnn_type is nn.LSTMCell:
+        if self.cell_type == "lstm":
             c = torch.zeros([batch_size, self.hidden_size], device=self.device)
             state = (h, c)
         else:
@@ -159,43 +273,139 @@ class Sender(nn.Module):
 
         return state, batch_size
 
-    def _calculate_seq_len(self, seq_lengths, token, initial_length, seq_pos):
+    def _rnn_step(self, emb, state):
+        """
+            Performs one step of the rnn cell with the scripted LSTM cell,
+            using the parameters of self.rnn.
+            Args:
+                emb (torch.tensor): Embedded input of the current timestep.
+                state (tuple): (h, c) of the previous timestep.
+            Returns:
+                state: (h, c) of the current timestep
+        """
+        h, c = state
+        return _lstm_cell(
+            emb,
+            h,
+            c,
+            self.rnn.weight_ih,
+            self.rnn.weight_hh,
+            self.rnn.bias_ih,
+            self.rnn.bias_hh,
+        )
+
+    def _linear_out(self, h):
+        """
+            Projects the hidden state with linear_out. Outside of training on cuda, the
+            matmul runs in bfloat16 under autocast, and the result is cast back to
+            float32 so that the sampling and distances stay in full precision.
+            Args:
+                h (torch.tensor): Hidden state of the current timestep.
+        """
+        device_type = torch.device(self.device).type
+        if self.training or device_type != "cuda":
+            return self.linear_out(h)
+
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            out = self.linear_out(h)
+
+        return out.float()
+
+    def _calculate_seq_len(
+        self, seq_lengths, token, initial_length, seq_pos, token_index=None
+    ):
         """
             Calculates the lengths of each sequence in the batch in-place.
             The length goes from the start of the sequece up until the eos_id is predicted.
             If it is not predicted, then the length is output_len + n_sos_symbols.
             Args:
                 seq_lengths (torch.tensor): To keep track of the sequence lengths.
-                token (torch.tensor): Batch of predicted tokens at this timestep.
+                token (torch.tensor): Batch of predicted tokens at this timestep,
+                    None if the tokens are only given by token_index.
                 initial_length (int): The max possible sequence length (output_len + n_sos_symbols).
                 seq_pos (int): The current timestep.
+                token_index (torch.tensor): Indices of the (one-hot) tokens, used if token is None.
         """
-        max_predicted, vocab_index = torch.max(token, dim=1)
-        mask = (vocab_index == self.eos_id) * (
-            max_predicted == 1.0
-        )  # all words in batch that are "already done"
-        mask = mask.to(self.device)
-        mask *= seq_lengths == initial_length
-        seq_lengths[mask.nonzero()] = (
-            seq_pos + 1
+        if token is None:
+            predicted_eos = token_index == self.eos_id
+        else:
+            max_predicted, vocab_index = torch.max(token, dim=1)
+            predicted_eos = (vocab_index == self.eos_id) & (max_predicted == 1.0)
+        done = predicted_eos & (
+            seq_lengths == initial_length
+        )  # all words in batch that end at this position and had not ended before
+        seq_lengths.masked_fill_(
+            done, seq_pos + 1
         )  # start always token appended. This tells the sequence
         # to be smaller at the positions where the sentence already ended.
+        # masked_fill_ stays on the device, unlike indexing with mask.nonzero().
 
-    def calculate_token_gumbel_softmax(self, p, tau, sentence_probability, batch_size):
+    def calculate_token_gumbel_softmax(self, logits, tau, gumbel=None):
+        """
+            Samples the token of the current timestep from unnormalized logits.
+            In training, a hard Gumbel Softmax sample is drawn. Otherwise the token is
+            the argmax (greedy) or drawn with the Gumbel-max trick, which samples from
+            the categorical distribution without normalizing the logits first.
+            Args:
+                logits (torch.tensor): Unnormalized log probabilities [batch_size, vocab_size].
+                tau (float): Temperature of the Gumbel Softmax.
+                gumbel (torch.tensor): Pre-sampled Gumbel noise for this timestep, drawn if None.
+            Returns:
+                token: The hard Gumbel Softmax token [batch_size, vocab_size] in training,
+                    None otherwise, where the one-hot token is only given by its index
+                token_index: The index of the token outside of training, None in training
+        """
+        token = None
+        token_index = None
         if self.training:
-            token = self.utils_helper.calculate_gumbel_softmax(p, tau, hard=True)
+            token = self.utils_helper.calculate_gumbel_softmax_hard(
+                logits, tau, gumbel
+            )
         else:
-            sentence_probability += p.detach()
-
             if self.greedy:
-                _, token = torch.max(p, -1)
+                _, token_index = torch.max(logits, -1)
             else:
-                token = Categorical(p).sample()
-            token = to_one_hot(token, n_dims=self.vocab_size)
+                token_index = self.utils_helper.calculate_gumbel_max(logits, gumbel)
+        return token, token_index
+
+    def _apply(self, fn, *args, **kwargs):
+        # Captured graphs point to the old storage of moved or converted tensors
+        self._cuda_graphs.clear()
+        return super()._apply(fn, *args, **kwargs)
 
-            if batch_size == 1:
-                token = token.unsqueeze(0)
-        return token, sentence_probability
+    def _unroll_cuda_graph(self, hidden_state):
+        """
+            Runs _unroll by replaying a CUDA graph. Kernel launches dominate the unroll
+            for small hidden sizes, and at eval time the launched kernels only depend on
+            the batch size, so a graph is captured once per batch size (and greedy
+            setting) and replayed afterwards. Only valid outside of training.
+            Args:
+                hidden_state (torch.tensor): The state to initialize the decoding with.
+        """
+        key = (hidden_state.shape[0], self.greedy)
+        if key not in self._cuda_graphs:
+            static_hidden_state = hidden_state.detach().clone()
+
+            # Warm up on a side stream before capturing, which also lets the
+            # scripted functions finish their profiling runs.
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream), torch.no_grad():
+                for _ in range(3):
+                    self._unroll(static_hidden_state)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.no_grad(), torch.cuda.graph(graph):
+                static_outputs = self._unroll(static_hidden_state)
+            self._cuda_graphs[key] = (graph, static_hidden_state, static_outputs)
+
+        graph, static_hidden_state, static_outputs = self._cuda_graphs[key]
+        static_hidden_state.copy_(hidden_state)
+        graph.replay()
+
+        # The static outputs are overwritten by the next replay
+        return tuple(output.clone() for output in static_outputs)
 
     def forward(self, hidden_state=None):
         """
@@ -203,31 +413,39 @@ class Sender(nn.Module):
         discrete sampling.
         Hidden state here represents the encoded image/metadata - initializes the RNN from it.
         """
+        if self.training:
+            return self._forward_train(hidden_state)
 
+        return self._forward_eval(hidden_state)
+
+    def _forward_train(self, hidden_state):
         hidden_state = self.input_module(hidden_state)
-        state, batch_size = self._init_state(hidden_state, type(self.rnn))
+        return self._unroll(hidden_state)
 
-        # Init output
-        if not (self.vqvae and not self.discrete_communication and not self.rl):
-            output = [
-                torch.zeros(
-                    (batch_size, self.vocab_size),
-                    dtype=torch.float32,
-                    device=self.device,
-                )
-            ]
-            output[0][:, self.sos_id] = 1.0
-        else:
-            # In vqvae case with continuous communication, there is no sos symbol, since all words come from the unordered embedding table.
-            # It is not possible to index code words by sos or eos symbols, since the number of codewords
-            # is not necessarily the vocab size!
-            output = [
-                torch.zeros(
-                    (batch_size, self.vocab_size),
-                    dtype=torch.float32,
-                    device=self.device,
-                )
-            ]
+    def _forward_eval(self, hidden_state):
+        """
+        Eval time forward pass. Runs under inference mode, which skips all autograd
+        bookkeeping, so the outputs are inference tensors: they can be read and used
+        in new computations, but not modified in-place or saved for backward, which
+        means callers should run under torch.no_grad() as well.
+        """
+        if torch.jit.is_tracing():
+            # Traced by export_for_inference, freezing takes over from inference mode
+            return self._unroll(self.input_module(hidden_state))
+
+        with torch.inference_mode():
+            hidden_state = self.input_module(hidden_state)
+
+            if self.cuda_graphs and hidden_state is not None and hidden_state.is_cuda:
+                return self._unroll_cuda_graph(hidden_state)
+
+            return self._unroll(hidden_state)
+
+    def _unroll(self, hidden_state):
+        """
+        Unrolls the sender from the (already transformed) hidden state and samples the message.
+        """
+        state, batch_size = self._init_state(hidden_state)
 
         # Keep track of sequence lengths
         initial_length = self.output_len + 1  # add the sos token
@@ -236,7 +454,49 @@ class Sender(nn.Module):
             * initial_length
         )  # [initial_length, initial_length, ..., initial_length]. This gets reduced whenever it ends somewhere.
 
-        embeds = []  # keep track of the embedded sequence
+        # Init output. Messages and embeddings are written step by step into
+        # preallocated buffers instead of being collected in lists and stacked.
+        messages = torch.zeros(
+            (batch_size, initial_length, self.vocab_size),
+            dtype=torch.float32,
+            device=self.device,
+        )
+        # In vqvae case with continuous communication, there is no sos symbol, since all words come from the unordered embedding table.
+        # It is not possible to index code words by sos or eos symbols, since the number of codewords
+        # is not necessarily the vocab size!
+        # The first input is the sos token, which never carries a gradient, so it is
+        # embedded with a lookup in every setting. Without a sos symbol it is all zeros.
+        if not (self.vqvae and not self.discrete_communication and not self.rl):
+            messages[:, 0, self.sos_id] = 1.0
+            token_index = torch.full(
+                (batch_size,), self.sos_id, dtype=torch.int64, device=self.device
+            )
+            emb = self._embed(token_index)
+        else:
+            emb = torch.zeros((batch_size, self.embedding_size), device=self.device)
+
+        # Tokens that carry no gradient back into the sender (at eval time and in rl)
+        # are exactly one-hot, so they are embedded with a lookup instead of a matmul.
+        # The hard Gumbel Softmax and HardMax tokens keep the matmul, since their
+        # straight-through gradient flows through it.
+        embed_by_index = not (
+            self.vqvae and not self.discrete_communication and not self.rl
+        ) and (self.rl or not self.training)
+
+        # With autograd, outputs that carry a gradient are collected in lists and
+        # stacked once after the unroll: writing them into a buffer would add an
+        # in-place copy per step to the graph, each of which copies the gradient of
+        # the whole buffer in backward.
+        collect_embeds = torch.is_grad_enabled()
+        collect_tokens = collect_embeds and not embed_by_index
+        tokens = [messages[:, 0]] if collect_tokens else None
+
+        if collect_embeds:
+            embeds = []  # keep track of the embedded sequence
+        else:
+            embeds = torch.empty(
+                (batch_size, self.output_len, self.embedding_size), device=self.device
+            )
         sentence_probability = torch.zeros(
             (batch_size, self.vocab_size), device=self.device
         )
@@ -244,100 +504,190 @@ class Sender(nn.Module):
         entropy = torch.empty((batch_size, self.output_len), device=self.device)
         message_logits = torch.empty((batch_size, self.output_len), device=self.device)
 
-        if self.vqvae:
-            distance_computer = EmbeddingtableDistances(self.e)
-            vq = VectorQuantization()
-            hard_max = HardMax()
+        # Logits that are only needed after the unroll (for the rl entropy and log
+        # probabilities, and the eval sentence probability) are collected for all
+        # timesteps and normalized at once, instead of once per timestep.
+        step_logits = None
+        step_token_indices = None
+        if self.rl or (not self.vqvae and not self.training):
+            step_logits = torch.empty(
+                (self.output_len, batch_size, self.vocab_size), device=self.device
+            )
+        if self.rl:
+            step_token_indices = torch.empty(
+                (self.output_len, batch_size), dtype=torch.int64, device=self.device
+            )
+
+        # The codebook only changes between forward passes, so its squared norms
+        # are computed once here and reused by the distances of every timestep.
+        e_sq = torch.sum(self.e * self.e, dim=1) if self.vqvae else None
+
+        # Gumbel noise for all timesteps, drawn at once, whenever tokens are sampled:
+        # by calculate_token_gumbel_softmax (baseline and vqvae with gumbel_softmax),
+        # with Gumbel Softmax in training and Gumbel-max at eval time unless greedy,
+        # and by Gumbel-max in rl training.
+        uses_softmax_sampling = not self.vqvae or (
+            self.discrete_communication and self.gumbel_softmax
+        )
+        samples_gumbel = (self.rl and self.training) or (
+            not self.rl
+            and uses_softmax_sampling
+            and (self.training or not self.greedy)
+        )
+        gumbel = None
+        if samples_gumbel:
+            gumbel = self.utils_helper.sample_gumbel(
+                (self.output_len, batch_size, self.vocab_size), self.device
+            )
+
+        # Without autograd nothing is saved for backward, so the VQ and HardMax
+        # tokens of all timesteps can be written into one buffer: each token is
+        # copied into messages and embedded before the next one overwrites it.
+        # Tokens embedded by index are never materialized, see below.
+        token_out = None
+        if self.vqvae and not embed_by_index and not torch.is_grad_enabled():
+            token_out = torch.empty((batch_size, self.vocab_size), device=self.device)
 
         for i in range(self.output_len):
 
-            emb = torch.matmul(output[-1], self.embedding)
+            if i > 0:
+                if embed_by_index:
+                    emb = self._embed(token_index)
+                else:
+                    emb = torch.matmul(token, self.embedding)
 
-            embeds.append(emb)
+            if collect_embeds:
+                embeds.append(emb)
+            else:
+                embeds[:, i] = emb
 
-            state = self.rnn(emb, state)
+            state = self._rnn_step(emb, state)
 
-            if type(self.rnn) is nn.LSTMCell:
+            if self.cell_type == "lstm":
                 h, _ = state
             else:
                 h = state
 
-            indices = [None] * batch_size
-
             if not self.rl:
                 if not self.vqvae:
                     # That's the original baseline setting
-                    p = F.softmax(self.linear_out(h), dim=1)
-                    token, sentence_probability = self.calculate_token_gumbel_softmax(
-                        p, self.tau, sentence_probability, batch_size
+                    logits = self._linear_out(h)
+                    token, token_index = self.calculate_token_gumbel_softmax(
+                        logits, self.tau, gumbel[i] if gumbel is not None else None
                     )
+                    if step_logits is not None:
+                        step_logits[i] = logits
                 else:
-                    pre_quant = self.linear_out(h)
+                    pre_quant = self._linear_out(h)
 
                     if not self.discrete_communication:
-                        token = vq.apply(pre_quant, self.e, indices)
+                        if self.training:
+                            token, indices = VectorQuantization.apply(
+                                pre_quant, self.e, e_sq, token_out
+                            )
+                        else:
+                            token, indices = VectorQuantization.quantize(
+                                pre_quant, self.e, e_sq, token_out
+                            )
                     else:
-                        distances = distance_computer(pre_quant)
-                        softmin = F.softmax(-distances, dim=1)
+                        distances = embeddingtable_distances(pre_quant, self.e, e_sq)
                         if not self.gumbel_softmax:
-                            token = hard_max.apply(
-                                softmin, indices, self.discrete_latent_number
-                            )  # This also updates the indices
+                            if embed_by_index:
+                                # The hard max of the softmin is the closest codeword
+                                token = None
+                                _, indices = torch.min(distances, dim=1)
+                            else:
+                                softmin = F.softmax(-distances, dim=1)
+                                token, indices = HardMax.apply(
+                                    softmin, self.discrete_latent_number, token_out
+                                )
+                            token_index = indices
                         else:
-                            token, _ = self.calculate_token_gumbel_softmax(
-                                softmin, self.tau, 0, batch_size
+                            token, token_index = self.calculate_token_gumbel_softmax(
+                                -distances,
+                                self.tau,
+                                gumbel[i] if gumbel is not None else None,
                             )
-                            _, indices[:] = torch.max(token, dim=1)
+                            if token_index is None:
+                                _, token_index = torch.max(token, dim=1)
+                            indices = token_index
 
             else:
                 if not self.vqvae:
-                    all_logits = F.log_softmax(self.linear_out(h) / self.tau, dim=1)
+                    all_logits = self._linear_out(h) / self.tau
                 else:
-                    pre_quant = self.linear_out(h)
-                    distances = distance_computer(pre_quant)
-                    all_logits = F.log_softmax(-distances / self.tau, dim=1)
-
-                distr = Categorical(logits=all_logits)
-                entropy[:, i] = distr.entropy()
+                    pre_quant = self._linear_out(h)
+                    distances = embeddingtable_distances(pre_quant, self.e, e_sq)
+                    all_logits = -distances / self.tau
+                step_logits[i] = all_logits
 
+                # Sampling does not depend on the normalization of the logits,
+                # which is done for all timesteps after the unroll.
                 if self.training:
-                    token_index = distr.sample()
-                    token = to_one_hot(token_index, n_dims=self.vocab_size)
+                    token_index = self.utils_helper.calculate_gumbel_max(
+                        all_logits, gumbel[i]
+                    )
                 else:
                     token_index = all_logits.argmax(dim=1)
-                    token = to_one_hot(token_index, n_dims=self.vocab_size)
-                _, indices[:] = torch.max(token, dim=1)
-                message_logits[:, i] = distr.log_prob(token_index)
+                step_token_indices[i] = token_index
+                token = None
+                indices = token_index
 
             if not (self.vqvae and not self.discrete_communication and not self.rl):
                 # Whenever we have a meaningful eos symbol, we prune the messages in the end
                 self._calculate_seq_len(
-                    seq_lengths, token, initial_length, seq_pos=i + 1
+                    seq_lengths,
+                    token,
+                    initial_length,
+                    seq_pos=i + 1,
+                    token_index=token_index,
                 )
 
             if self.vqvae:
-
-                loss_2 = torch.mean(
-                    torch.norm(pre_quant.detach() - self.e[indices], dim=1) ** 2
+                # Second and third loss term in VQ-VAE, ||sg(z) - e||^2 + beta * ||z - sg(e)||^2,
+                # computed with a single difference and reduction: both terms share the
+                # forward value ||z - e||^2, the codebook gets the full gradient and the
+                # encoder output z only beta of it.
+                pre_quant_scaled = pre_quant.detach() + self.beta * (
+                    pre_quant - pre_quant.detach()
                 )
-                loss_3 = torch.mean(
-                    torch.norm(pre_quant - self.e[indices].detach(), dim=1) ** 2
-                )
-                loss_2_3 = loss_2 + self.beta * loss_3   # This corresponds to the second and third loss term in VQ-VAE
-                losses_2_3[i] = loss_2_3
-
-
-            token = token.to(self.device)
-            output.append(token)
+                diff = pre_quant_scaled - self.e.index_select(0, indices)
+                loss_sq = diff.pow(2).sum(dim=1).mean()
+                losses_2_3[i] = loss_sq + self.beta * loss_sq.detach()
+
+            if token is None:
+                # One-hot tokens without a gradient (see embed_by_index) are only kept
+                # as indices, and written straight into the zero-initialized buffer.
+                messages[:, i + 1].scatter_(1, token_index.unsqueeze(1), 1.0)
+            elif collect_tokens:
+                tokens.append(token)
+            else:
+                messages[:, i + 1] = token
+
+        if collect_embeds:
+            embeds = torch.stack(embeds, dim=1)
+        if collect_tokens:
+            messages = torch.stack(tokens, dim=1)
+
+        if self.rl:
+            # Entropy and log probability straight from the log softmax, as in
+            # Categorical. Clamping keeps 0 * log(0) at 0 instead of nan.
+            log_probs = F.log_softmax(step_logits, dim=2)
+            log_probs_clamped = log_probs.clamp(min=torch.finfo(log_probs.dtype).min)
+            entropy = -(log_probs.exp() * log_probs_clamped).sum(dim=2).t()
+            message_logits = (
+                log_probs.gather(2, step_token_indices.unsqueeze(2)).squeeze(2).t()
+            )
+        elif step_logits is not None:
+            sentence_probability = F.softmax(step_logits, dim=2).sum(dim=0)
 
-        messages = torch.stack(output, dim=1)
         loss_2_3_out = torch.mean(losses_2_3)
 
         return (
             messages,
             seq_lengths,
             entropy,
-            torch.stack(embeds, dim=1),
+            embeds,
             sentence_probability,
             loss_2_3_out,
             message_logits,
@@ -1,74 +1,88 @@
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
-
-# this utils function is taken from https://discuss.pytorch.org/t/convert-int-into-one-hot-format/507/23
-def to_one_hot(y, n_dims=None):
-    """ Take integer y (tensor or variable) with n dims and convert it to 1-hot representation with n+1 dims. """
-    y_tensor = y.data if isinstance(y, Variable) else y
-    y_tensor = y_tensor.type(torch.LongTensor).view(-1, 1)
-    n_dims = n_dims if n_dims is not None else int(torch.max(y_tensor)) + 1
-    y_one_hot = torch.zeros(y_tensor.size()[0], n_dims).scatter_(1, y_tensor, 1)
-    y_one_hot = y_one_hot.view(*y.shape, -1)
-    return Variable(y_one_hot) if isinstance(y, Variable) else y_one_hot
 
 
 class HardMax(torch.autograd.Function):
     """
-    Takes a softmax vector and returns the hard max.
+    Takes a softmax vector and returns the hard max, together with the
+    indices of the maxima as a (non-differentiable) tensor.
+    If given, the hard max is written into the preallocated tensor out.
     With straight-through gradient.
     """
 
     @staticmethod
-    def forward(ctx, softmax, max_indices, n_dims):
+    def forward(ctx, softmax, n_dims, out=None):
 
-        _, max_indices[:] = torch.max(softmax, dim=1)
-        hard_max = to_one_hot(torch.Tensor(max_indices), n_dims)
+        _, max_indices = torch.max(softmax, dim=1)
+        if out is None:
+            out = softmax.new_zeros((softmax.shape[0], n_dims))
+        else:
+            out.zero_()
+            ctx.mark_dirty(out)
+        hard_max = out.scatter_(1, max_indices.unsqueeze(1), 1.0)
 
-        return hard_max
+        ctx.mark_non_differentiable(max_indices)
+        return hard_max, max_indices
 
     @staticmethod
-    def backward(ctx, grad_hard_max):
+    def backward(ctx, grad_hard_max, grad_max_indices):
         return grad_hard_max, None, None
 
 
 class VectorQuantization(torch.autograd.Function):
     """
     A function that compares the input of the forward pass to the embedding table.
-    returns the closest embedding vector.
+    returns the closest embedding vector, together with its index in the
+    embedding table as a (non-differentiable) tensor.
+    If given, the closest vectors are written into the preallocated tensor out.
     Backward pass is straight-through.
     Inspired by VQ-VAE (van den Oord et al., 2018).
     """
 
     @staticmethod
-    def forward(ctx, pre_quant, e, indices):
-        distance_computer = EmbeddingtableDistances(e)
+    def forward(ctx, pre_quant, e, e_sq=None, out=None):
+        quantized, indices = VectorQuantization.quantize(pre_quant, e, e_sq, out)
+        if out is not None:
+            ctx.mark_dirty(out)
+
+        ctx.mark_non_differentiable(indices)
+        return quantized, indices
 
-        distances = distance_computer.forward(pre_quant)
-        _, indices[:] = torch.min(
+    @staticmethod
+    def quantize(pre_quant, e, e_sq=None, out=None):
+        """
+        The computation of the forward pass, without the autograd function around it,
+        for use when no straight-through gradient is needed.
+        """
+        distances = embeddingtable_distances(pre_quant, e, e_sq)
+        _, indices = torch.min(
             distances, dim=1
         )  # indices lists, for each vector in the batch pre_quant, the index of the closest codeword
 
-        return e[indices]
+        if out is None:
+            quantized = e.index_select(0, indices)
+        else:
+            quantized = torch.index_select(e, 0, indices, out=out)
+
+        return quantized, indices
 
     @staticmethod
-    def backward(ctx, grad_e):
-        return grad_e, None, None
-
-
-class EmbeddingtableDistances(nn.Module):
-    def __init__(self, e):
-        super().__init__()
-        self.register_buffer("e", e)  # The embedding table from VQ-VAE
-
-    def forward(self, pre_quant):
-        # Use ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab for computation of distances.
-        # Square computation:
-        e_sq = torch.sum(self.e ** 2, dim=1)
-        pre_quant_sq = torch.sum(pre_quant ** 2, dim=1, keepdim=True)
-
-        # Compute the distances to the codebook e
-        distances = torch.addmm(
-            e_sq + pre_quant_sq, pre_quant, self.e.t(), alpha=-2.0, beta=1.0
-        )
-        return distances
+    def backward(ctx, grad_e, grad_indices):
+        return grad_e, None, None, None
+
+
+def embeddingtable_distances(pre_quant, e, e_sq=None):
+    """ Squared distances between each vector in pre_quant [batch_size, dim] and each
+    vector of the embedding table e [n_vectors, dim], of shape [batch_size, n_vectors].
+    e_sq holds the squared norms of the vectors in e, if already computed.
+    """
+    # Use ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab for computation of distances,
+    # so only a single matmul is needed and no [batch_size, n_vectors, dim] difference.
+    # Square computation:
+    if e_sq is None:
+        e_sq = torch.sum(e * e, dim=1)
+    pre_quant_sq = torch.sum(pre_quant * pre_quant, dim=1, keepdim=True)
+
+    # Compute the distances to the codebook e
+    distances = torch.addmm(e_sq + pre_quant_sq, pre_quant, e.t(), alpha=-2.0, beta=1.0)
+    return distances
@@ -161,6 +161,11 @@ def parse_arguments(args):
         help="switch for using REINFORCE for training the sender",
         action="store_true",
     )
+    parser.add_argument(
+        "--cuda_graphs",
+        help="switch for replaying the sender unroll from CUDA graphs at evaluation time",
+        action="store_true",
+    )
     parser.add_argument(
         "--entropy_coefficient",
         type=float,